@@ -15,7 +15,7 @@ def run_esn(dataset, device, dim_reduction=True):
     # Set ESN hyperparams
     config = json.load(open('ESN/configs/ESN_hyperparams.json', 'r'))
 
-    Xtr, Ytr, Xval, Yval, Xte, Yte, diffXte, diffYte = generate_datasets(data, L, F, test_percent = 0.25, val_percent = 0.25)
+    Xtr, Ytr, Xval, Yval, Xte, Yte, diffXte, diffYte = generate_datasets(data, L, F, test_percent = 0.25, val_percent = 0.25, name = dataset)
     print("Tr: {:d}, Val: {:d}, Te: {:d}".format(Xtr.shape[0], Xval.shape[0], Xte.shape[0]))
 
     # Train and compute predictions
@@ -48,4 +48,8 @@ def to_torch(array, device):
     
     dtype = 'float32'
     array = array.astype(dtype)
-    return from_numpy(array).to(device)
\ No newline at end of file
+    tensor = from_numpy(array)
+    if device.type == 'cuda':
+        # Asynchronous copy from pinned memory
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
\ No newline at end of file
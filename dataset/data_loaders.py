@@ -1,11 +1,17 @@
+import os
+import hashlib
+import functools
 import numpy as np
 import pandas as pd
 
-from scipy.io import loadmat
+from pathlib import Path
 from sklearn.preprocessing import StandardScaler
 from torch import from_numpy
-from pytorch_forecasting import TimeSeriesDataSet
-from pytorch_forecasting.data import EncoderNormalizer
+
+CACHE_PATH = 'dataset/cache/'
+DATASETS = ["Xtr", "Ytr", "Xval", "Yval", "Xte", "Yte", "diffXte", "diffYte"]
+# Version of the cached datasets, bump it when the output of `_generate_datasets` changes
+DATASETS_VERSION = 1
 
 
 def load_dataset(name):
@@ -17,10 +23,14 @@ def load_dataset(name):
         raise ValueError(f"{name} dataset not defined.")
 
 
+@functools.lru_cache(maxsize=None)
 def load_acea():
     seasonality = 24*7 # 1 week
     forecast_horizon = 24 # 1 day
 
+    # Imported here since scipy.io is only needed for this dataset
+    from scipy.io import loadmat
+
     mat = loadmat('dataset/TS_Acea.mat')  # load mat-file
     ACEA_data = mat['X'] # original resolution (1 = 10 mins)
     ACEA_data = ACEA_data[::6] # hourly forecast
@@ -31,16 +41,16 @@ def load_acea():
     return ACEA_data.squeeze(), seasonality, forecast_horizon
 
 
+@functools.lru_cache(maxsize=None)
 def load_spain():
     """
     Spanish energy market daily data.
     Source: https://www.kaggle.com/code/manualrg/daily-electricity-demand-forecast-machine-learning/data
     """
 
-    spain_power_data = np.genfromtxt('dataset/spain_energy_market.csv', delimiter=',', dtype=None, encoding=None)
-    data = spain_power_data[...,5] # select column with values
-    data = data[spain_power_data[...,2] == 'Demanda real'] # select energy demand values
-    data = data.astype(float) # convert into floats
+    spain_power_data = pd.read_csv('dataset/spain_energy_market.csv', usecols=['name', 'value'], engine='pyarrow')
+    data = spain_power_data.loc[spain_power_data['name'] == 'Demanda real', 'value'] # select energy demand values
+    data = data.to_numpy(np.float64) # convert into floats
 
     seasonality = 7 # 1 week
     forecast_horizon = 1 # 1 week
@@ -48,20 +58,45 @@ def load_spain():
     return data, seasonality, forecast_horizon
 
 
-def generate_datasets(data, seasonality, forecast_horizon, test_percent = 0.15, val_percent = 0.15, scaler = StandardScaler):
+def generate_datasets(data, seasonality, forecast_horizon, test_percent = 0.15, val_percent = 0.15, scaler = StandardScaler, name = None):
+    """
+    Generate train, validation and test sets.
+    If the dataset `name` is given, they are cached on disk and memory-mapped on the next calls.
+    """
+
+    if name is None:
+        return _generate_datasets(data, seasonality, forecast_horizon, test_percent, val_percent, scaler)
+
+    key = (DATASETS_VERSION, name, seasonality, forecast_horizon, test_percent, val_percent, scaler.__name__)
+    cache_path = CACHE_PATH + hashlib.md5(repr(key).encode()).hexdigest() + '/'
+    files = [cache_path + f'{d}.npy' for d in DATASETS]
+
+    if all(os.path.isfile(f) for f in files):
+        return tuple(np.load(f, mmap_mode='r') for f in files)
+
+    datasets = _generate_datasets(data, seasonality, forecast_horizon, test_percent, val_percent, scaler)
+
+    Path(cache_path).mkdir(parents=True, exist_ok=True) # create folder if it does not exist
+    for f, d in zip(files, datasets):
+        np.save(f, d)
+
+    return datasets
+
+
+def _generate_datasets(data, seasonality, forecast_horizon, test_percent, val_percent, scaler):
 
     L = seasonality
     F = forecast_horizon
 
     assert F<=L, "The forecast horizon must be smaller or equal to the seasonality."
 
-    s = pd.Series(data)
-    
+    data = np.asarray(data, dtype=np.float64)
+
     # Remove seasonality
-    sn = s.diff(periods=L)[L:]
-    sn = sn.to_numpy(float)
+    sn = np.ascontiguousarray(data[L:] - data[:-L])
 
-    diff = (data[L:] - sn)
+    # The seasonality removed, i.e. data[L:] - sn
+    diff = np.ascontiguousarray(data[:-L])
 
     X = sn[:-F, np.newaxis]
     Y = sn[F:, np.newaxis]
@@ -70,9 +105,7 @@ def generate_datasets(data, seasonality, forecast_horizon, test_percent = 0.15,
 
     n_data,_ = X.shape
 
-    n_te = np.ceil(test_percent*n_data).astype(int)
-    n_val = np.ceil(val_percent*n_data).astype(int)
-    n_tr = n_data - n_te - n_val
+    n_tr, n_val, n_te = split_sizes(n_data, val_percent, test_percent)
 
     # Split dataset
     Xtr = X[:n_tr, :]
@@ -87,24 +120,35 @@ def generate_datasets(data, seasonality, forecast_horizon, test_percent = 0.15,
     diffYte = diffY[-n_te:, :]
 
     # Scale
-    Xscaler = scaler()
-    Yscaler = scaler()
+    if scaler is StandardScaler:
+        # Same as StandardScaler, with the statistics computed once on the training set
+        x_mean, x_std = _mean_std(Xtr)
+        y_mean, y_std = _mean_std(Ytr)
 
-    # Fit scaler on training set
-    Xtr = Xscaler.fit_transform(Xtr)
-    Ytr = Yscaler.fit_transform(Ytr)
+        Xtr, Xval, Xte = [_standardize(X, x_mean, x_std) for X in (Xtr, Xval, Xte)]
+        Ytr, Yval, Yte = [_standardize(Y, y_mean, y_std) for Y in (Ytr, Yval, Yte)]
+
+        # Transform the difference due to the seasonality
+        diffXte, diffYte = [_standardize(d, x_mean, x_std, with_mean=False) for d in (diffXte, diffYte)]
+    else:
+        Xscaler = scaler()
+        Yscaler = scaler()
 
-    # Transform the rest
-    Xval = Xscaler.transform(Xval)
-    Yval = Yscaler.transform(Yval)
+        # Fit scaler on training set
+        Xtr = Xscaler.fit_transform(Xtr)
+        Ytr = Yscaler.fit_transform(Ytr)
 
-    Xte = Xscaler.transform(Xte)
-    Yte = Yscaler.transform(Yte)
+        # Transform the rest
+        Xval = Xscaler.transform(Xval)
+        Yval = Yscaler.transform(Yval)
 
-    # Transform the difference due to the seasonality
-    Xscaler.with_mean = False
-    diffXte = Xscaler.transform(diffXte)
-    diffYte = Xscaler.transform(diffYte)
+        Xte = Xscaler.transform(Xte)
+        Yte = Yscaler.transform(Yte)
+
+        # Transform the difference due to the seasonality
+        Xscaler.with_mean = False
+        diffXte = Xscaler.transform(diffXte)
+        diffYte = Xscaler.transform(diffYte)
 
     # add constant input
     Xtr = np.concatenate((Xtr,np.ones((Xtr.shape[0],1))),axis=1)
@@ -114,13 +158,47 @@ def generate_datasets(data, seasonality, forecast_horizon, test_percent = 0.15,
     return Xtr, Ytr, Xval, Yval, Xte, Yte, diffXte, diffYte
 
 
+def split_sizes(n, val_percent = 0.15, test_percent = 0.15):
+    """
+    Sizes of the train, validation and test splits of n samples, computed with integer arithmetic
+    """
+
+    # Ceil of n*percent, with the percents in parts per million so that e.g. 0.07*100 is 7 and not 8
+    n_te = -(-n*round(test_percent*1_000_000) // 1_000_000)
+    n_val = -(-n*round(val_percent*1_000_000) // 1_000_000)
+    return n - n_val - n_te, n_val, n_te
+
+
+def _mean_std(X):
+    """
+    Mean and standard deviation of each column, a zero deviation is replaced by 1 as in StandardScaler
+    """
+
+    mean = X.mean(axis=0)
+    std = X.std(axis=0)
+    std[std == 0.] = 1.
+    return mean, std
+
+
+def _standardize(X, mean, std, with_mean=True):
+    """
+    Standardize a copy of X, the arrays X come from overlapping views of the same series
+    """
+
+    X = np.array(X, dtype=np.float64)
+    if with_mean:
+        np.subtract(X, mean, out=X)
+    np.divide(X, std, out=X)
+    return X
+
+
 def dataset_for_arima(name, device):
     """
     Load dataset to use with ARIMA
     """
 
     data, L, F = load_dataset(name)
-    Xtr, Ytr, Xval, Yval, Xte, Yte, diffXte, diffYte = generate_datasets(data, L, F, test_percent = 0.15, val_percent = 0.15)
+    Xtr, Ytr, Xval, Yval, Xte, Yte, diffXte, diffYte = generate_datasets(data, L, F, test_percent = 0.15, val_percent = 0.15, name = name)
 
     Xtr, Ytr = to_torch(Xtr, device)[:,0], to_torch(Ytr, device).squeeze()
     Xval, Yval = to_torch(Xval, device)[:,0], to_torch(Yval, device).squeeze()
@@ -135,15 +213,17 @@ def dataset_for_deepar(name, max_encoder_length = 10, batch_size = 64, scaler =
     Load dataset to use with DeepAR
     """
 
+    # Imported here since pytorch_forecasting is slow to import and only needed for DeepAR
+    from pytorch_forecasting import TimeSeriesDataSet
+    from pytorch_forecasting.data import EncoderNormalizer
+
     data, L, F = load_dataset(name)
 
     test_percent = 0.15
     val_percent = 0.15
 
     n_data = data.shape[0]
-    n_te = int(np.ceil(test_percent*n_data))
-    n_val = int(np.ceil(val_percent*n_data))
-    n_tr = n_data - n_te - n_val
+    n_tr, n_val, n_te = split_sizes(n_data, val_percent, test_percent)
 
     # Scale
     Xscaler = scaler()
@@ -203,4 +283,8 @@ def to_torch(array, device):
     
     dtype = 'float32'
     array = array.astype(dtype)
-    return from_numpy(array).to(device)
\ No newline at end of file
+    tensor = from_numpy(array)
+    if device.type == 'cuda':
+        # Asynchronous copy from pinned memory
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
\ No newline at end of file
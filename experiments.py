@@ -3,18 +3,21 @@ import torch
 import wandb
 import os
 import json
+import hashlib
 import warnings
 
 import numpy as np
 import pandas as pd
 
+from joblib import Parallel, delayed
+from numpy.lib.recfunctions import structured_to_unstructured
 from pyro.infer.autoguide import AutoMultivariateNormal, AutoLowRankMultivariateNormal, init_to_mean
 from pathlib import Path
-from inference.bayesian.models import TorchModel, BayesianModel, HorseshoeSSVS
+from safetensors import safe_open
+from safetensors.torch import save_file
+from inference.bayesian.models import TorchModel, BayesianModel, HorseshoeSSVS, AutoReplicatedMultivariateNormal
 from inference.inference import inference
 from ESN.utils import run_esn
-from pytorch_forecasting import DeepAR
-from pytorch_forecasting.metrics import NormalDistributionLoss
 from dataset.data_loaders import dataset_for_arima, dataset_for_deepar
 
 warnings.simplefilter("ignore", UserWarning)
@@ -27,13 +30,17 @@ config = {
             "parameters": [[0,1],[0,1]],
             "dim_reduction": False,
             "dropout_p": 0.2,
+            "compile": False,
             "num_chains": 2,
             "num_samples": 8000,
+            "numpyro": False,
             "inference": "deepar",
             "lr": 0.03,
             "num_iterations": 2000,
+            "jit": True,
             "low_rank": True,
-            "rank": None,
+            "rank": 16,
+            "vectorize_seeds": False,
             "plot": False,
             "seed": 10,
             "print_results": True,
@@ -64,18 +71,45 @@ if torch.cuda.is_available():
 else:
     device = torch.device('cpu')
 
-# Save/Load ESN state
-n_internal_units = json.load(open('ESN/configs/ESN_hyperparams.json', 'r'))['n_internal_units']
+# Use the tensor cores with TF32 matmuls on Ampere or newer GPUs
+tensor_cores = torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+if tensor_cores:
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cuda.matmul.allow_tf32 = True
+
+# Save/Load ESN state, the file is keyed by the ESN hyperparams and the dataset
+esn_hyperparams = json.load(open('ESN/configs/ESN_hyperparams.json', 'r'))
+esn_key = hashlib.blake2b(json.dumps(esn_hyperparams, sort_keys=True).encode() + config.dataset.encode(), digest_size=8).hexdigest()
 save_path = './ESN/saved/' + f'{config.dataset}/dim_red_{config.dim_reduction}/'
 Path(save_path).mkdir(parents=True, exist_ok=True) # create folder if it does not exist
-file_path = save_path + f'esn_states_{n_internal_units}units.pt'
+file_path = save_path + f'esn_states_{esn_key}.safetensors'
+
+# Version of the format of the saved states, a file with another version is recomputed
+ESN_STATES_VERSION = 2
+STATES = ["Ytr", "train_embedding", "Yval", "val_embedding", "Yte", "test_embedding"]
 
 if config.esn:
+    states = None
     if os.path.isfile(file_path):
-        Ytr, train_embedding, Yval, val_embedding, Yte, test_embedding = torch.load(file_path, map_location=torch.device(device))
+        # safetensors memory-maps the file, so pages are read on demand
+        with safe_open(file_path, framework="pt", device="cpu") as f:
+            if (f.metadata() or {}).get("version") == str(ESN_STATES_VERSION):
+                states = [f.get_tensor(k) for k in STATES]
+
+    if states is not None:
+        if device.type == 'cuda':
+            # Copies from pinned memory don't block the host, which can go on with the setup
+            states = [t.pin_memory().to(device, non_blocking=True) for t in states]
+        # Embeddings are stored in bf16, upcast them after the copy to the device
+        Ytr, train_embedding, Yval, val_embedding, Yte, test_embedding = [t.float() for t in states]
     else:
         Ytr, train_embedding, Yval, val_embedding, Yte, test_embedding, _, _ = run_esn(config.dataset, device, dim_reduction=config.dim_reduction)
-        torch.save([Ytr, train_embedding, Yval, val_embedding, Yte, test_embedding], file_path)
+        # The targets are kept in fp32, the embeddings in bf16 halve the file size
+        states = [t.detach().to(torch.bfloat16 if "embedding" in k else torch.float32) for k, t in
+                  zip(STATES, [Ytr, train_embedding, Yval, val_embedding, Yte, test_embedding])]
+        save_file({k: t.cpu().contiguous() for k, t in zip(STATES, states)}, file_path, metadata={"version": str(ESN_STATES_VERSION)})
+        # Train on the rounded embeddings as well, so a fresh run matches the runs loading the file
+        Ytr, train_embedding, Yval, val_embedding, Yte, test_embedding = [t.float() for t in states]
     horizon = None
 else:
     # ARIMA
@@ -89,26 +123,54 @@ else:
     else:
         raise ValueError(f"{config.inference} method not implemented.")
 
+# NumPyro works on JAX arrays, convert the training data only once
+X_train, Y_train = train_embedding, Ytr
+if config.numpyro:
+    if config.inference not in ["mcmc", "ssvs"]:
+        raise ValueError(f"NumPyro backend not implemented for {config.inference}.")
+    # Imported here since JAX and NumPyro are only needed by this backend
+    import jax
+    from inference.bayesian import numpyro_models
+
+    X_train, Y_train = numpyro_models.torch_to_jax(train_embedding), numpyro_models.torch_to_jax(Ytr)
+
 
 # Quantiles
-quantiles = [0, 0.005]
-for n in range(39):
-    quantiles.append(0.025*(n+1))
-quantiles.append(0.995)
-
-
-train_times = []
-inf_times = []
-cal_errors, new_cal_errors = [], []
-e_crpss = []
-crpss, new_crpss = [], []
-losses = []
-widths, new_widths = [], []
-mses, new_mses = [], []
-coverages, new_coverages = [], []
+quantiles = np.concatenate(([0, 0.005], 0.025*np.arange(1, 40), [0.995]))
+
+
+# Preallocated diagnostics, one row for each seed
+names = ["train_time", "inf_time", "cal_error", "new_cal_error", "width", "new_width",
+         "crps", "new_crps", "mse", "new_mse", "cov", "new_cov", "final_loss"]
+diag = np.zeros(config.seed, dtype=[(n, 'f8') for n in names])
 grs, effs = [], []
 
-for s in range(config.seed):
+# SVI can fit all the seeds at once with a model replicated along a "seeds" plate
+if config.vectorize_seeds and config.inference != "svi":
+    raise ValueError(f"Vectorized seeds not implemented for {config.inference}.")
+replicas = config.seed if config.vectorize_seeds else None
+n_runs = 1 if config.vectorize_seeds else config.seed
+
+# The replicas are trained and evaluated together, so they share the times and the loss
+SHARED = ["train_time", "inf_time", "final_loss"]
+
+
+class RunConfig(dict):
+    """
+    Picklable copy of the wandb config, with the same attribute access
+    """
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+
+def run_seed(s, config):
+    """
+    Train and evaluate the model with seed `s`, return the diagnostics of each of its runs
+    """
+
     # Set seed for reproducibility
     pyro.set_rng_seed(s)
     np.random.seed(s)
@@ -117,6 +179,8 @@ for s in range(config.seed):
 
     torch_model = TorchModel(config.model_widths, config.activation).to(device)
     guide = None
+    nuts_model = None
+    rng_key = None
     if config.inference == "ssvs":
         model = HorseshoeSSVS(config.activation, device=device)
     elif config.inference == "q_regr":
@@ -126,6 +190,10 @@ for s in range(config.seed):
     elif config.inference == "arima":
         model = None
     elif config.inference == "deepar":
+        # Imported here since pytorch_forecasting is slow to import and only needed for DeepAR
+        from pytorch_forecasting import DeepAR
+        from pytorch_forecasting.metrics import NormalDistributionLoss
+
         model = DeepAR.from_dataset(
             training,
             learning_rate=config.lr,
@@ -135,124 +203,140 @@ for s in range(config.seed):
             optimizer="Adam",
         )
     else:
-        model = BayesianModel(torch_model, config, device)
-
-        # To enforce all the parameters in the guide on the GPU, since we use an autoguide
-        if device != 'cpu':
-            torch.set_default_tensor_type('torch.cuda.FloatTensor')
-
-        if not config.low_rank:
+        # On the tensor cores the low rank SVI runs the network in bfloat16
+        mixed_precision = tensor_cores and config.low_rank and config.inference == "svi"
+        model = BayesianModel(torch_model, config, device, replicas=replicas, mixed_precision=mixed_precision)
+
+        # A small rank keeps the cost of the low rank covariance linear in the number of parameters.
+        # The parameters of torch_model are PyroSamples now, count them from the widths
+        if config.inference == "svi" and config.low_rank and config.rank is not None:
+            w = config.model_widths
+            num_params = sum(w[i]*w[i+1] + w[i+1] for i in range(len(w)-1)) + 1 # and the noise sigma
+            assert config.rank < num_params, f"The rank {config.rank} must be smaller than the number of parameters {num_params}."
+
+        if replicas is not None:
+            guide = AutoReplicatedMultivariateNormal(model, replicas, init_loc_fn=init_to_mean, low_rank=config.low_rank, rank=config.rank)
+        elif not config.low_rank:
             guide = AutoMultivariateNormal(model, init_loc_fn=init_to_mean)
         else:
             guide = AutoLowRankMultivariateNormal(model, init_loc_fn=init_to_mean, rank=config.rank)
 
+    # Compile the deterministic models, and warm them up outside of the timed training.
+    # Each mode and input shape has its own graph, and the training also needs the backward graph.
+    # The Pyro models and guides (SVI, MCMC, SSVS) are not compiled, they rely on the jit option.
+    if config.compile and config.inference in ["q_regr", "dropout"]:
+        model = torch.compile(model, mode='reduce-overhead', dynamic=False)
+        for train_mode in [True, False]:
+            model.train(train_mode)
+            for X in [train_embedding, val_embedding, test_embedding]:
+                out = model(X)
+                if train_mode and X is train_embedding:
+                    out.sum().backward()
+        model.zero_grad(set_to_none=True)
+
+    if config.numpyro:
+        if config.inference == "ssvs":
+            nuts_model = numpyro_models.HorseshoeSSVS(config.activation)
+        else:
+            nuts_model = numpyro_models.BayesianModel(config.model_widths, config.activation, config)
+        # Creating a key initializes the XLA backend, so it's done only for NumPyro
+        rng_key = jax.random.PRNGKey(s)
+
+    # The autoguide creates its parameters at its first call, set it up here
+    # so that any tensor it creates without an explicit device goes on `device`.
+    # Only the setup runs in the device mode, which adds an overhead to every op.
+    if guide is not None and config.inference == "svi":
+        with torch.device(device):
+            guide(X_train, Y_train)
+
+    # Wait for the asynchronous copies of the data, so they are not timed with the training
+    if device.type == 'cuda':
+        torch.cuda.current_stream().synchronize()
+
     # Perform inference
-    predictive, diagnostics = inference(config, model, guide, 
-                                        X_train=train_embedding, Y_train=Ytr, 
+    predictive, diagnostics = inference(config, model, guide,
+                                        X_train=X_train, Y_train=Y_train,
                                         X_val=val_embedding, Y_val=Yval,
                                         X_test=test_embedding, Y_test=Yte,
                                         quantiles=quantiles,
                                         horizon=horizon,
-                                        device=device)
-
-
-    train_times.append(diagnostics['train_time'])
-    cal_errors.append(diagnostics['cal_error'])
-    new_cal_errors.append(diagnostics['new_cal_error'])
-    widths.append(diagnostics['width'])
-    new_widths.append(diagnostics['new_width'])
-    crpss.append(diagnostics['crps'])
-    new_crpss.append(diagnostics['new_crps'])
-    mses.append(diagnostics['mse'])
-    new_mses.append(diagnostics['new_mse'])
-    coverages.append(diagnostics['coverage'])
-    new_coverages.append(diagnostics['new_coverage'])
-
-    if "final_loss" in diagnostics.keys(): # MCMC doesn't have a loss
-        losses.append(diagnostics['final_loss'])
-    else:
-        losses.append(0)
+                                        device=device,
+                                        nuts_model=nuts_model,
+                                        rng_key=rng_key)
+
+
+    # Same name as the field of `diag`, MCMC doesn't have a inference_time
+    diagnostics["inf_time"] = diagnostics.pop("inference_time", 0)
+
+    # Diagnostics of the replicas are stacked along axis 0, except the totals they share
+    runs = [{k: v if k in SHARED else v[r] for k, v in diagnostics.items()} for r in range(replicas)] if replicas is not None else [diagnostics]
+
+    return runs
+
+
+# Without CUDA the seeds run in parallel, one process per core, each with its own param store.
+# QR, dropout and DeepAR write their checkpoints and logs to fixed paths, as do the plots,
+# so they stay sequential. NumPyro stays sequential too, since XLA already uses all the cores.
+parallel = config.inference in ["svi", "mcmc", "ssvs", "arima"] and not config.plot and not config.numpyro
+n_jobs = min(os.cpu_count(), n_runs) if device.type == 'cpu' and parallel else 1
+results = Parallel(n_jobs=n_jobs)(delayed(run_seed)(s, RunConfig(config.as_dict())) for s in range(n_runs))
+
+for s, runs in enumerate(results):
+    for r, diagnostics in enumerate(runs):
+        i = s*len(runs) + r # seed index
+        diag['train_time'][i] = diagnostics['train_time']
+        diag['cal_error'][i] = diagnostics['cal_error']
+        diag['new_cal_error'][i] = diagnostics['new_cal_error']
+        diag['width'][i] = diagnostics['width']
+        diag['new_width'][i] = diagnostics['new_width']
+        diag['crps'][i] = diagnostics['crps']
+        diag['new_crps'][i] = diagnostics['new_crps']
+        diag['mse'][i] = diagnostics['mse']
+        diag['new_mse'][i] = diagnostics['new_mse']
+        diag['cov'][i] = diagnostics['coverage']
+        diag['new_cov'][i] = diagnostics['new_coverage']
+        diag['final_loss'][i] = diagnostics.get('final_loss', 0) # MCMC doesn't have a loss
+        diag['inf_time'][i] = diagnostics['inf_time']
+
+        if "gelman_rubin" in diagnostics.keys(): # only MCMC methods have the gelman rubin factor
+            grs.append(diagnostics['gelman_rubin'])
+        else:
+            grs.append(0)
 
-    if "inference_time" in diagnostics.keys(): # MCMC doesn't have a inference_time
-        inf_times.append(diagnostics['inference_time'])
-    else:
-        inf_times.append(0)
+        if "effective_sample_size" in diagnostics.keys(): # only MCMC methods have the gelman rubin factor
+            effs.append(diagnostics['effective_sample_size'])
+        else:
+            effs.append(0)
 
-    if "gelman_rubin" in diagnostics.keys(): # only MCMC methods have the gelman rubin factor
-        grs.append(diagnostics['gelman_rubin'])
-    else:
-        grs.append(0)
 
-    if "effective_sample_size" in diagnostics.keys(): # only MCMC methods have the gelman rubin factor
-        effs.append(diagnostics['effective_sample_size'])
-    else:
-        effs.append(0)
-
-
-
-m_time = np.asarray(train_times).mean()
-s_time = np.asarray(train_times).std()
-m_inf_time = np.asarray(inf_times).mean()
-s_inf_time = np.asarray(inf_times).std()
-m_cal = np.asarray(cal_errors).mean()
-s_cal = np.asarray(cal_errors).std()
-m_new_cal = np.asarray(new_cal_errors).mean()
-s_new_cal = np.asarray(new_cal_errors).std()
-m_width = np.asarray(widths).mean()
-s_width = np.asarray(widths).std()
-m_new_width = np.asarray(new_widths).mean()
-s_new_width = np.asarray(new_widths).std()
-m_crps = np.asarray(crpss).mean()
-s_crps = np.asarray(crpss).std()
-m_new_crps = np.asarray(new_crpss).mean()
-s_new_crps = np.asarray(new_crpss).std()
-m_mse = np.asarray(mses).mean()
-s_mse = np.asarray(mses).std()
-m_new_mse = np.asarray(new_mses).mean()
-s_new_mse = np.asarray(new_mses).std()
-m_cov = np.asarray(coverages).mean()
-s_cov = np.asarray(coverages).std()
-m_new_cov = np.asarray(new_coverages).mean()
-s_new_cov = np.asarray(new_coverages).std()
-m_loss = np.asarray(losses).mean()
-s_loss = np.asarray(losses).std()
-
-
-wandb.log({"m_train_time": m_time,
-           "s_train_time": s_time,
-           "m_cal_error": m_cal,
-           "s_cal_error": s_cal,
-           "m_new_cal_error": m_new_cal,
-           "s_new_cal_error": s_new_cal,
-           "m_crps": m_crps,
-           "s_crps": s_crps,
-           "m_new_crps": m_new_crps,
-           "s_new_crps": s_new_crps,
-           "m_mse": m_mse,
-           "s_mse": s_mse,
-           "m_new_mse": m_new_mse,
-           "s_new_mse": s_new_mse,
-           "m_width": m_width,
-           "s_width": s_width,
-           "m_new_width": m_new_width,
-           "s_new_width": s_new_width,
-           "m_cov": m_cov,
-           "s_cov": s_cov,
-           "m_new_cov": m_new_cov,
-           "s_new_cov": s_new_cov,
-           "m_final_loss": m_loss,
-           "s_final_loss": s_loss,
+
+# Mean and std over the seeds of all the metrics at once
+all_metrics = structured_to_unstructured(diag)
+means = all_metrics.mean(axis=0)
+stds = all_metrics.std(axis=0)
+# The shared totals are the same for all the seeds, they have no std
+if replicas is not None:
+    stds[[names.index(n) for n in SHARED]] = np.nan
+
+# Log all the metrics at once
+metrics = {**{f"m_{n}": m for n, m in zip(names, means)},
+           **{f"s_{n}": v for n, v in zip(names, stds)},
            "gel_rub": grs,
-           "eff_size": effs})
+           "eff_size": effs}
+
+wandb.log(metrics)
 
 
 if config.print_results:
-    df = pd.DataFrame({"seed": range(config.seed), "train_times": train_times, "inf_times": inf_times,
-                       "cal_errors": cal_errors, "new_cal_errors": new_cal_errors,
-                       "coverage": coverages, "new_coverage": new_coverages,
-                       "width": widths, "new_width": new_widths,
-                       "MSE": mses, "new_MSE": new_mses,
-                       "CRPS": crpss, "new_CRPS": new_crpss,
-                       "final_loss": losses})
-    with pd.ExcelWriter(f"results/results.xlsx", mode="a", engine="openpyxl", if_sheet_exists="replace") as writer:
-        df.to_excel(writer, sheet_name=f"sheet_{config.dataset}_{config.inference}", index=False) 
\ No newline at end of file
+    df = pd.DataFrame({"seed": range(config.seed), "train_times": diag['train_time'], "inf_times": diag['inf_time'],
+                       "cal_errors": diag['cal_error'], "new_cal_errors": diag['new_cal_error'],
+                       "coverage": diag['cov'], "new_coverage": diag['new_cov'],
+                       "width": diag['width'], "new_width": diag['new_width'],
+                       "MSE": diag['mse'], "new_MSE": diag['new_mse'],
+                       "CRPS": diag['crps'], "new_CRPS": diag['new_crps'],
+                       "final_loss": diag['final_loss']})
+    if replicas is not None:
+        df = df.rename(columns={"train_times": "total_train_times", "inf_times": "total_inf_times", "final_loss": "total_final_loss"})
+    # One CSV for each dataset and method, instead of rewriting a whole workbook
+    Path("results").mkdir(parents=True, exist_ok=True) # create folder if it does not exist
+    df.to_csv(f"results/results_{config.dataset}_{config.inference}.csv", index=False)
@@ -1,17 +1,14 @@
 import torch
 
 import numpy as np
-import lightning.pytorch as pl
 
 from time import process_time
 from pyro import clear_param_store
 from pyro.optim import Adam
-from pyro.infer import SVI, Trace_ELBO, Predictive, MCMC, NUTS
+from pyro.infer import SVI, Trace_ELBO, JitTrace_ELBO, Predictive, MCMC, NUTS
 from pyro.ops.stats import autocorrelation
 from pyro.contrib.forecast.evaluate import eval_crps
 from tqdm import trange
-from pytorch_forecasting import DeepAR
-from pytorch_lightning.loggers import TensorBoardLogger
 
 from inference.bayesian.utils import check_convergence, acceptance_rate, calibrate, compute_coverage_len, num_eval_crps
 from inference.early_stopping import EarlyStopping
@@ -22,10 +19,12 @@ from inference.early_stopping import EarlyStopping
 #           Variational Inference       #
 #########################################
 
-def train_SVI(model, guide, X, Y, lr=0.03, num_iterations=120):
+def train_SVI(model, guide, X, Y, lr=0.03, num_iterations=120, jit=False):
     
     optim = Adam({"lr": lr})
-    svi = SVI(model, guide, optim, loss=Trace_ELBO())
+    # With `jit` the ELBO is traced at the first step and replayed afterwards
+    elbo = JitTrace_ELBO(num_particles=1, ignore_jit_warnings=True) if jit else Trace_ELBO()
+    svi = SVI(model, guide, optim, loss=elbo)
 
     # Clear the param store first, if it was already used
     clear_param_store()
@@ -45,6 +44,7 @@ def train_SVI(model, guide, X, Y, lr=0.03, num_iterations=120):
 
     guide.requires_grad_(False)
 
+    # With a replicated model the time and the loss are totals shared by all the replicas
     diagnostics = {
         "train_time": train_time,
         "final_loss": loss / Y.shape[0]
@@ -53,7 +53,7 @@ def train_SVI(model, guide, X, Y, lr=0.03, num_iterations=120):
     return diagnostics
 
 
-def pred_SVI(model, guide, X_val, Y_val, X_test, Y_test, num_samples, plot, sweep, diagnostics, quantiles):
+def pred_SVI(model, guide, X_val, Y_val, X_test, Y_test, num_samples, plot, sweep, diagnostics, quantiles, replicas=None):
 
     # Use validation set for hyperparameters tuning
     if sweep:
@@ -67,24 +67,44 @@ def pred_SVI(model, guide, X_val, Y_val, X_test, Y_test, num_samples, plot, swee
     start_time = process_time()
     predictive = Predictive(model, guide=guide, num_samples=num_samples)(x=X, y=None)
     inference_time = process_time() - start_time
-    diagnostics["inference_time"] = inference_time
 
     # Compute calibration error
     predictive2 = Predictive(model, guide=guide, num_samples=num_samples)(x=X2, y=None)
+
+    # With `replicas` the inference time is a total shared by all the replicas
+    diagnostics["inference_time"] = inference_time
+
+    if replicas is None:
+        diagnostics = eval_SVI(predictive["obs"].cpu().numpy().squeeze(), predictive2["obs"].cpu().numpy().squeeze(),
+                               Y, Y2, plot, diagnostics, quantiles)
+    else:
+        # Evaluate each replica separately, and stack its diagnostics along axis 0
+        obs, obs2 = predictive["obs"].cpu().numpy(), predictive2["obs"].cpu().numpy()
+        replica_diagnostics = [eval_SVI(obs[:,r,:], obs2[:,r,:], Y, Y2, plot, {}, quantiles) for r in range(replicas)]
+        for k in replica_diagnostics[0].keys():
+            diagnostics[k] = np.stack([d[k] for d in replica_diagnostics], axis=0)
+
+    return predictive, diagnostics
+
+
+def eval_SVI(samples, samples2, Y, Y2, plot, diagnostics, quantiles):
+    """
+    Compute the metrics of the predictive `samples` of Y,
+    the predictive `samples2` of Y2 are used for calibration
+    """
+
     # Calibrate
-    cal_error, new_cal_error, new_quantiles = calibrate(predictive["obs"].cpu().numpy().squeeze(), 
-                                                        predictive2["obs"].cpu().numpy().squeeze(), 
-                                                        Y, Y2, quantiles, folder="svi", plot=plot)
+    cal_error, new_cal_error, new_quantiles = calibrate(samples, samples2, Y, Y2, quantiles, folder="svi", plot=plot)
     diagnostics["cal_error"] = cal_error
     diagnostics["new_cal_error"] = new_cal_error
     diagnostics["quantiles"] = quantiles
     diagnostics["new_quantiles"] = new_quantiles
 
     # Width at 0.95 quantile
-    q_low, q_hi = np.quantile(predictive["obs"].cpu().numpy().squeeze(), [quantiles[2], quantiles[-2]], axis=0) # 40-quantile
+    q_low, q_hi = np.quantile(samples, [quantiles[2], quantiles[-2]], axis=0) # 40-quantile
     diagnostics["width"] = np.mean(q_hi - q_low)
     # After calibration
-    new_q_low, new_q_hi = np.quantile(predictive["obs"].cpu().numpy().squeeze(), [new_quantiles[2], new_quantiles[-2]], axis=0) # 40-quantile
+    new_q_low, new_q_hi = np.quantile(samples, [new_quantiles[2], new_quantiles[-2]], axis=0) # 40-quantile
     diagnostics["new_width"] = np.mean(new_q_hi - new_q_low)
 
     # Check coverage with 95% quantiles
@@ -97,24 +117,24 @@ def pred_SVI(model, guide, X_val, Y_val, X_test, Y_test, num_samples, plot, swee
     diagnostics["new_avg_length"] = avg_length
 
     # Mean Squared Error wrt the median
-    median = np.quantile(predictive["obs"].cpu().numpy().squeeze(), quantiles[int(len(quantiles)/2)], axis=0) # median
+    median = np.quantile(samples, quantiles[int(len(quantiles)/2)], axis=0) # median
     mse = np.mean((median-Y.cpu().numpy())**2)
     diagnostics["mse"] = mse
     # After calibration
-    median = np.quantile(predictive["obs"].cpu().numpy().squeeze(), new_quantiles[int(len(new_quantiles)/2)], axis=0) # median
+    median = np.quantile(samples, new_quantiles[int(len(new_quantiles)/2)], axis=0) # median
     mse = np.mean((median-Y.cpu().numpy())**2)
     diagnostics["new_mse"] = mse
 
     # Numerical continuous ranked probability score
-    tau = np.quantile(predictive["obs"].cpu().numpy().squeeze(), quantiles, axis=0)
+    tau = np.quantile(samples, quantiles, axis=0)
     n_crps = num_eval_crps(quantiles, tau, Y.cpu().squeeze().numpy())
     diagnostics["crps"] = n_crps
     # Compute CRPS after calibration
-    tau = np.quantile(predictive["obs"].cpu().numpy().squeeze(), new_quantiles, axis=0)
+    tau = np.quantile(samples, new_quantiles, axis=0)
     new_n_crps = num_eval_crps(new_quantiles, tau, Y.cpu().squeeze().numpy())
     diagnostics["new_crps"] = new_n_crps
 
-    return predictive, diagnostics
+    return diagnostics
 
 
 
@@ -123,7 +143,7 @@ def pred_SVI(model, guide, X_val, Y_val, X_test, Y_test, num_samples, plot, swee
 #########################################
 
 
-def train_MCMC(model, X, Y, num_chains, num_samples, sweep):
+def train_MCMC(model, X, Y, num_chains, num_samples, sweep, jit=False):
 
     # Define a hook to log the acceptance rate and step size at each iteration
     step_size = []
@@ -143,7 +163,7 @@ def train_MCMC(model, X, Y, num_chains, num_samples, sweep):
 
     for n in range(num_chains):
         # Use NUTS kernel
-        nuts_kernel = NUTS(model)
+        nuts_kernel = NUTS(model, jit_compile=jit, ignore_jit_warnings=True)
 
         mcmc = MCMC(nuts_kernel, num_samples=num_samples, warmup_steps=0, num_chains=1, hook_fn=acc_rate_hook)
 
@@ -179,6 +199,47 @@ def train_MCMC(model, X, Y, num_chains, num_samples, sweep):
     return samples, diagnostics
 
 
+def train_NUTS(model, X, Y, num_chains, num_samples, rng_key, device):
+    """
+    Same as `train_MCMC`, but the NUTS sampler runs with NumPyro and JAX.
+    `X` and `Y` are JAX arrays, the returned samples are torch tensors on `device`.
+    """
+
+    # Imported here since JAX and NumPyro are only needed by this backend
+    import numpyro
+    from inference.bayesian.numpyro_models import jax_to_torch
+
+    nuts_kernel = numpyro.infer.NUTS(model)
+
+    # All the chains run at once, vectorized over the leading dimension
+    mcmc = numpyro.infer.MCMC(nuts_kernel, num_warmup=0, num_samples=num_samples, num_chains=num_chains, chain_method='vectorized')
+
+    # Run the MCMC and compute the training time
+    start_time = process_time()
+    mcmc.run(rng_key, X, Y, extra_fields=("adapt_state.step_size", "mean_accept_prob"))
+    chains = mcmc.get_samples(group_by_chain=True)
+    train_time = process_time() - start_time
+
+    # Split the chains to match the output of `train_MCMC`
+    samples = [{k: jax_to_torch(v[n], device) for k, v in chains.items()} for n in range(num_chains)]
+
+    extra_fields = mcmc.get_extra_fields(group_by_chain=True)
+    step_size = np.asarray(extra_fields["adapt_state.step_size"]).reshape((num_chains,num_samples))
+    acc_rate = acceptance_rate(np.asarray(extra_fields["mean_accept_prob"]).reshape((num_chains,num_samples)))
+
+    # Save diagnostics in dict
+    diagnostics = {
+        "step_size": step_size,
+        "acceptance_rate": acc_rate,
+        # The chains run together, as in `train_MCMC` report the CPU time (process_time) per chain.
+        # Both times include the JIT compilation, when there is one.
+        "train_time": train_time / num_chains,
+        "autocorrelation": []
+    }
+
+    return samples, diagnostics
+
+
 def pred_MCMC(model, samples, X_val, Y_val, X_test, Y_test, plot, sweep, diagnostics, inference_name, quantiles):
 
     # Use validation set for hyperparameters tuning
@@ -419,6 +480,11 @@ def pred_DO(model, X_val, Y_val, X_test, Y_test, num_samples, plot, sweep, diagn
 
 def train_deepAR(model, train_dataloader, val_dataloader, epochs, device):
 
+    # Imported here since lightning and pytorch_forecasting are slow to import and only needed for DeepAR
+    import lightning.pytorch as pl
+    from pytorch_forecasting import DeepAR
+    from pytorch_lightning.loggers import TensorBoardLogger
+
     accelerator = "gpu" if device.type == "cuda" else "cpu"
     model = model.to(device)
     
@@ -3,7 +3,12 @@ import pyro
 
 import pyro.distributions as dist
 
-from pyro.nn import PyroModule, PyroSample
+from contextlib import nullcontext
+from pyro.distributions import constraints
+from torch.distributions.transforms import ReshapeTransform
+from pyro.distributions.transforms import Permute
+from pyro.infer.autoguide import AutoContinuous, init_to_median
+from pyro.nn import PyroModule, PyroSample, PyroParam
 
 
 class TorchModel(torch.nn.Module):
@@ -34,12 +39,19 @@ class TorchModel(torch.nn.Module):
             if dropout:
                 self.layers.append(dp)
         
-        output = widths[-1] if quantiles==None else len(quantiles)
+        output = widths[-1] if quantiles is None else len(quantiles)
         self.layers.append(torch.nn.Linear(widths[-2], output))
 
     def forward(self, x):
         for f in self.layers:
-            x = f(x)
+            if isinstance(f, torch.nn.Linear) and f.weight.dim() > 2:
+                # Parameters replicated along the leading dims, as in BayesianModel with `replicas`
+                w = f.weight.reshape(-1, *f.weight.shape[-2:])
+                b = f.bias.reshape(-1, 1, f.bias.shape[-1])
+                # baddbmm keeps a single dtype in the traced backward under autocast, unlike `@` and `+`
+                x = torch.baddbmm(b, x.expand(w.shape[0], *x.shape[-2:]), w.transpose(-1, -2))
+            else:
+                x = f(x)
         return x
 
 
@@ -50,13 +62,17 @@ class BayesianModel(PyroModule):
     :param torch_model: TorchModel object to transform into probabilistic model.
     :param config: Configuration settings.
     :param string device: String specifying the device to use, 'cpu' or 'cuda'.
+    :param int replicas: If given, number of independent copies of the model stacked along a "seeds" plate.
+    :param bool mixed_precision: If True, the forward of the TorchModel runs in bfloat16 on CUDA.
     """
-    def __init__(self, torch_model, config, device):
+    def __init__(self, torch_model, config, device, replicas=None, mixed_precision=False):
         super().__init__()
 
         self.device = device
         self.config = config
         self.model = torch_model
+        self.replicas = replicas
+        self.mixed_precision = mixed_precision
 
         self.distributions = self._get_priors()
         
@@ -64,15 +80,26 @@ class BayesianModel(PyroModule):
 
 
     def forward(self, x, y=None):
-        mean = self.model(x).squeeze(-1)
+        with self._seeds_plate():
+            # Only the linear layers run in bfloat16, the sample sites and the guide stay in float32
+            with torch.autocast('cuda', dtype=torch.bfloat16, enabled=self.mixed_precision):
+                mean = self.model(x).squeeze(-1)
+            mean = mean.float()
 
-        sigma = pyro.sample("sigma", self.distributions[-2]).to(self.device)
+            sigma = pyro.sample("sigma", self.distributions[-2]).to(self.device)
 
-        # with pyro.plate("data", size=x.shape[0], subsample_size=50, device=self.device) as ind:
-        with pyro.plate("data", device=self.device):
-            obs = pyro.sample("obs", self.distributions[-1](mean, sigma), obs=y).to(self.device)
+            # with pyro.plate("data", size=x.shape[0], subsample_size=50, device=self.device) as ind:
+            with pyro.plate("data", device=self.device):
+                obs = pyro.sample("obs", self.distributions[-1](mean, sigma), obs=y).to(self.device)
         return mean
 
+
+    def _seeds_plate(self):
+        if self.replicas is None:
+            return nullcontext()
+        # Dim -1 is left to the data plate
+        return pyro.plate("seeds", self.replicas, dim=-2, device=self.device)
+
     
     def _torch2pyro(self):
         pyro.nn.module.to_pyro_module_(self.model)
@@ -125,6 +152,77 @@ class BayesianModel(PyroModule):
         return pyro.render_model(self, model_args, render_distributions=True, filename=filename)
 
 
+class AutoReplicatedMultivariateNormal(AutoContinuous):
+    """
+    Multivariate Normal autoguide for a BayesianModel with `replicas`.
+    Each replica has its own covariance, so that the replicas are fitted independently,
+    instead of sharing a single covariance as with AutoMultivariateNormal.
+
+    :param model: BayesianModel with `replicas`.
+    :param int replicas: Number of replicas of the model.
+    :param bool low_rank: Whether to use a low rank plus diagonal covariance for each replica.
+    :param int rank: Rank of the covariance when `low_rank`, by default the square root of the replica latent size.
+    """
+
+    scale_constraint = constraints.softplus_positive
+
+    def __init__(self, model, replicas, init_loc_fn=init_to_median, init_scale=0.1, low_rank=False, rank=None):
+        if not isinstance(init_scale, float) or not (init_scale > 0):
+            raise ValueError(f"Expected init_scale > 0. but got {init_scale}")
+        self.replicas = replicas
+        self.low_rank = low_rank
+        self.rank = rank
+        self._init_scale = init_scale
+        super().__init__(model, init_loc_fn=init_loc_fn)
+
+
+    def _setup_prototype(self, *args, **kwargs):
+        super()._setup_prototype(*args, **kwargs)
+
+        R = self.replicas
+        D = self.latent_dim // R
+
+        # The latent vector is ordered by site, with the replicas inside each site.
+        # Find the permutation from an ordering by replica, with the sites inside each replica.
+        index = torch.arange(self.latent_dim).reshape(R, D)
+        perm, pos = [], 0
+        for name, _ in self.prototype_trace.iter_stochastic_nodes():
+            size = self._unconstrained_shapes[name].numel() // R
+            perm.append(index[:, pos:pos+size].reshape(-1))
+            pos += size
+        perm = torch.cat(perm)
+
+        loc = self._init_loc()
+        self._perm = perm.to(loc.device)
+        self._shape = (R, D)
+
+        # Initialize guide params, one set for each replica
+        replica_loc = torch.empty_like(loc)
+        replica_loc[self._perm] = loc
+        self.loc = torch.nn.Parameter(replica_loc.reshape(R, D))
+        if self.low_rank:
+            if self.rank is None:
+                self.rank = int(round(D**0.5))
+            self.scale = PyroParam(self.loc.new_full((R, D), 0.5**0.5 * self._init_scale), constraint=self.scale_constraint)
+            self.cov_factor = torch.nn.Parameter(self.loc.new_empty(R, D, self.rank).normal_(0, 1 / self.rank**0.5))
+        else:
+            self.scale = PyroParam(torch.full_like(self.loc, self._init_scale), self.scale_constraint)
+            self.scale_tril = PyroParam(torch.eye(D, dtype=loc.dtype, device=loc.device).expand(R, D, D).clone(), constraints.unit_lower_cholesky)
+
+
+    def get_posterior(self, *args, **kwargs):
+        if self.low_rank:
+            cov_factor = self.cov_factor * self.scale.unsqueeze(-1)
+            cov_diag = self.scale * self.scale
+            base = dist.LowRankMultivariateNormal(self.loc, cov_factor, cov_diag)
+        else:
+            scale_tril = self.scale[..., None] * self.scale_tril
+            base = dist.MultivariateNormal(self.loc, scale_tril=scale_tril)
+
+        # Go back to the flat latent vector ordered by site
+        return dist.TransformedDistribution(base.to_event(1), [ReshapeTransform(self._shape, (self.latent_dim,)), Permute(self._perm)])
+
+
 class BayesianLinear_m(PyroModule):
     """
     Linear Bayesian model with no activations for SSVS built "manually"
@@ -179,13 +277,15 @@ class HorseshoeSSVS(PyroModule):
             raise ValueError(f"{activation} not defined.")
 
     def forward(self, x, y=None):
-        tau = pyro.sample("tau", dist.HalfCauchy(1.)).to(self.device)
-        lamb = pyro.sample("lamb", dist.HalfCauchy(1.)).expand(x.shape[1]).to(self.device)
+        one = torch.tensor(1., device=self.device)
+
+        tau = pyro.sample("tau", dist.HalfCauchy(one)).to(self.device)
+        lamb = pyro.sample("lamb", dist.HalfCauchy(one)).expand(x.shape[1]).to(self.device)
         sig = (lamb*tau)**2
-        gamma = pyro.sample("gamma", dist.Normal(0, sig)).to(self.device)
+        gamma = pyro.sample("gamma", dist.Normal(torch.tensor(0., device=self.device), sig)).to(self.device)
 
         mean = self.a(x @ gamma)
-        sigma = pyro.sample("sigma", dist.Uniform(0., 10.)).to(self.device)
+        sigma = pyro.sample("sigma", dist.Uniform(torch.tensor(0., device=self.device), 10*one)).to(self.device)
 
         with pyro.plate("data", x.shape[0], device=self.device):
             obs = pyro.sample("obs", dist.Normal(mean, sigma), obs=y)
@@ -0,0 +1,113 @@
+import jax
+import torch
+import numpyro
+
+import numpy as np
+import jax.numpy as jnp
+import numpyro.distributions as dist
+
+
+class BayesianModel:
+    """
+    NumPyro version of the probabilistic model built from a TorchModel.
+    Sample sites are named after the parameters of the Pyro BayesianModel,
+    so the posterior samples can be used directly with it for prediction.
+
+    :param list widths: List of layers' widths.
+    :param string activation: String specifying the activation function to use.
+    :param config: Configuration settings.
+    """
+    def __init__(self, widths, activation, config):
+        self.widths = widths
+        self.config = config
+        self.a = _get_activation(activation)
+
+        self.distributions = self._get_priors()
+
+
+    def __call__(self, x, y=None):
+        n_layers = len(self.widths)-1
+
+        for i in range(n_layers):
+            # In the TorchModel each hidden linear layer is followed by its activation
+            name = f"model.layers.{2*i}"
+            w = numpyro.sample(f"{name}.weight", self.distributions[0].expand((self.widths[i+1], self.widths[i])).to_event(2))
+            b = numpyro.sample(f"{name}.bias", self.distributions[0].expand((self.widths[i+1],)).to_event(1))
+            x = x @ w.T + b
+            if i < n_layers-1:
+                x = self.a(x)
+
+        mean = x.squeeze(-1)
+
+        sigma = numpyro.sample("sigma", self.distributions[-2])
+
+        with numpyro.plate("data", x.shape[0]):
+            obs = numpyro.sample("obs", self.distributions[-1](mean, sigma), obs=y)
+        return mean
+
+
+    def _get_priors(self):
+        priors = {"gauss": dist.Normal, "unif": dist.Uniform, "lapl": dist.Laplace}
+
+        distributions = []
+        distr_list = self.config.distributions
+        param_list = self.config.parameters
+
+        for i in range(len(distr_list)):
+            if distr_list[i] not in priors:
+                raise ValueError(f"{distr_list[i]} prior distribution not defined.")
+
+            if i < len(param_list):
+                p = param_list[i]
+                distributions.append(priors[distr_list[i]](float(p[0]), float(p[1])))
+            else:
+                distributions.append(priors[distr_list[i]])
+
+        return distributions
+
+
+class HorseshoeSSVS:
+    """
+    NumPyro version of the SSVS implemented with an horseshoe continuous RV
+    """
+    def __init__(self, activation):
+        self.a = _get_activation(activation)
+
+    def __call__(self, x, y=None):
+        tau = numpyro.sample("tau", dist.HalfCauchy(1.))
+        lamb = jnp.broadcast_to(numpyro.sample("lamb", dist.HalfCauchy(1.)), (x.shape[1],))
+        sig = (lamb*tau)**2
+        gamma = numpyro.sample("gamma", dist.Normal(0., sig))
+
+        mean = self.a(x @ gamma)
+        sigma = numpyro.sample("sigma", dist.Uniform(0., 10.))
+
+        with numpyro.plate("data", x.shape[0]):
+            obs = numpyro.sample("obs", dist.Normal(mean, sigma), obs=y)
+
+        return mean
+
+
+def _get_activation(activation):
+    if activation == "tanh":
+        return jnp.tanh
+    elif activation == "relu":
+        return jax.nn.relu
+    else:
+        raise ValueError(f"{activation} not defined.")
+
+
+def torch_to_jax(tensor):
+    """
+    Transform torch tensors to JAX arrays
+    """
+
+    return jnp.asarray(tensor.detach().cpu().numpy())
+
+
+def jax_to_torch(array, device):
+    """
+    Transform JAX arrays to torch tensors and move them to `device`
+    """
+
+    return torch.from_numpy(np.array(array)).to(device)
@@ -23,13 +23,16 @@ def train_QR(model, X, Y, X_val, Y_val, lr, epochs, quantiles):
     checkpoint_path = "./checkpoints/QR/"
     early_stopping = EarlyStopping(patience=20, verbose=False, path=checkpoint_path)
 
+    # Move the quantiles to the device only once
+    quantiles_t = torch.as_tensor(quantiles, dtype=torch.float32, device=X.device)
+
     start_time = process_time()
 
     with trange(epochs) as t:
         for epoch in t:
             model.train()
             torch_optimizer.zero_grad()
-            loss = quantile_loss(quantiles, model(X), Y)
+            loss = quantile_loss(quantiles_t, model(X), Y)
             loss.backward()
             torch_optimizer.step()
 
@@ -39,7 +42,7 @@ def train_QR(model, X, Y, X_val, Y_val, lr, epochs, quantiles):
 
             # Early stopping
             model.eval()
-            valid_loss = quantile_loss(quantiles, model(X_val), Y_val).item()
+            valid_loss = quantile_loss(quantiles_t, model(X_val), Y_val).item()
 
             # early_stopping needs the validation loss to check if it has decresed, 
             # and if it has, it will make a checkpoint of the current model
@@ -76,12 +79,13 @@ def pred_QR(model, X_val, Y_val, X_test, Y_test, plot, sweep, diagnostics, quant
 
     # Perform inference
     start_time = process_time()
-    predictive = model(X).detach().squeeze()
+    # Clone the outputs, a compiled model can reuse their memory at the next call
+    predictive = model(X).detach().squeeze().clone()
     inference_time = process_time() - start_time
     diagnostics["inference_time"] = inference_time
 
     # Compute calibration error
-    predictive2 = model(X2).detach().squeeze()
+    predictive2 = model(X2).detach().squeeze().clone()
     # Calibrate
     # calibration doesn't make sense for QR
     cal_error, new_cal_error, new_quantiles = calibrate(predictive, predictive2, Y, Y2, quantiles, folder="q_regr", plot=plot)
@@ -124,11 +128,10 @@ def pred_QR(model, X_val, Y_val, X_test, Y_test, plot, sweep, diagnostics, quant
 
 
 def quantile_loss(quantiles, output, target):
-    losses = []
-    for i, q in enumerate(quantiles):
-        error = target-output[:,i]
-        losses.append(torch.max(q*error, (q-1)*error))
-    loss = torch.mean(torch.sum(torch.stack(losses), dim=-1))
+    # Pinball loss of all the quantiles at once, `quantiles` is a tensor
+    error = target.unsqueeze(-1)-output
+    losses = torch.max(quantiles*error, (quantiles-1)*error)
+    loss = torch.mean(torch.sum(losses, dim=0))
     return loss
 
 
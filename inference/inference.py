@@ -1,15 +1,21 @@
-from inference.bayesian.methods import train_SVI, pred_SVI, train_MCMC, pred_MCMC, train_DO, pred_DO, train_deepAR, pred_deepAR
+from inference.bayesian.methods import train_SVI, pred_SVI, train_MCMC, train_NUTS, pred_MCMC, train_DO, pred_DO, train_deepAR, pred_deepAR
 from inference.frequentist.methods import train_QR, pred_QR, train_ARIMA, pred_ARIMA
 
 
-def inference(config, model, guide, X_train, Y_train, X_val, Y_val, X_test, Y_test, quantiles=None, horizon=None, device=None):
+def inference(config, model, guide, X_train, Y_train, X_val, Y_val, X_test, Y_test, quantiles=None, horizon=None, device=None, nuts_model=None, rng_key=None):
     if config.inference == "svi":
-        diagnostics = train_SVI(model, guide, X_train, Y_train, config.lr, config.num_iterations)
-        predictive, diagnostics = pred_SVI(model, guide, X_val, Y_val, X_test, Y_test, config.num_samples, config.plot, config.sweep, diagnostics, quantiles)
+        # All the seeds can be fitted at once by a replicated model
+        replicas = config.seed if config.get("vectorize_seeds", False) else None
+        diagnostics = train_SVI(model, guide, X_train, Y_train, config.lr, config.num_iterations, config.get("jit", False))
+        predictive, diagnostics = pred_SVI(model, guide, X_val, Y_val, X_test, Y_test, config.num_samples, config.plot, config.sweep, diagnostics, quantiles, replicas)
         return predictive, diagnostics
 
     elif config.inference == "mcmc" or config.inference == "ssvs":
-        samples, diagnostics = train_MCMC(model, X_train, Y_train, config.num_chains, config.num_samples, config.sweep)
+        if config.get("numpyro", False):
+            # Sample with NumPyro, predict with the equivalent Pyro `model`
+            samples, diagnostics = train_NUTS(nuts_model, X_train, Y_train, config.num_chains, config.num_samples, rng_key, device)
+        else:
+            samples, diagnostics = train_MCMC(model, X_train, Y_train, config.num_chains, config.num_samples, config.sweep, config.get("jit", False))
         predictive, diagnostics = pred_MCMC(model, samples, X_val, Y_val, X_test, Y_test, config.plot, config.sweep, diagnostics, config.inference, quantiles)
         return predictive, diagnostics
 